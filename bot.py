@@ -1,21 +1,38 @@
 import os
-import json
 import time
+import asyncio
+import queue
+import atexit
+import functools
+import signal
+import sqlite3
 import logging
-from typing import Any, Dict, Optional
-
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Awaitable, Callable, Coroutine, Dict, List, Optional, Set
+
+import ijson
+import orjson
+try:
+    import uvloop
+except ImportError:  # uvloop нет под Windows — тогда обычный asyncio loop
+    uvloop = None
 from dotenv import load_dotenv
 from telegram import (
+    Message,
+    MessageEntity,
     Update,
+    User,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     ReplyKeyboardMarkup,
     KeyboardButton,
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden
+from telegram.request import HTTPXRequest
 from telegram.ext import (
+    AIORateLimiter,
     Application,
-    CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     ContextTypes,
@@ -29,11 +46,17 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # Можно переопределить путь на Railway через переменную USERS_PATH
 USERS_PATH = os.getenv("USERS_PATH", os.path.join(BASE_DIR, "users.json"))
+# База пользователей; по умолчанию рядом с USERS_PATH (users.json импортируется при первом запуске)
+USERS_DB_PATH = os.getenv("USERS_DB_PATH", os.path.splitext(USERS_PATH)[0] + ".db")
 
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 ADMIN_ID = os.getenv("ADMIN_ID", "").strip()  # numeric string
+try:
+    ADMIN_CHAT_ID: Optional[int] = int(ADMIN_ID) if ADMIN_ID else None
+except ValueError:  # мусор в ADMIN_ID — как будто админ не задан
+    ADMIN_CHAT_ID = None
 SITE_URL = os.getenv("SITE_URL", "https://financeacademy.online").strip()
 PAYMENT_TEXT = """
 💳 Реквизиты для оплаты курса
@@ -59,8 +82,22 @@ GROUP_BASIC_URL = os.getenv("GROUP_BASIC_URL", "").strip()
 GROUP_PRO_URL = os.getenv("GROUP_PRO_URL", "").strip()
 GROUP_VIP_URL = os.getenv("GROUP_VIP_URL", "").strip()
 
+# Webhook: если PUBLIC_URL задан — Telegram сам присылает апдейты на
+# PUBLIC_URL/WEBHOOK_PATH (TLS терминирует прокси Railway/nginx), иначе long polling
+PUBLIC_URL = os.getenv("PUBLIC_URL", "").strip().rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip().strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+PORT = int(os.getenv("PORT", "8080"))
+# Только те типы апдейтов, на которые есть хендлеры (сообщения и inline-кнопки)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+# Long polling: Telegram держит getUpdates открытым до POLL_TIMEOUT сек (максимум ~50)
+POLL_TIMEOUT = 30
+
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is not set")
+# без секрета любой, кто угадал URL, может прислать поддельный апдейт (например, /approve от имени админа)
+if PUBLIC_URL and not WEBHOOK_SECRET:
+    raise RuntimeError("WEBHOOK_SECRET is not set (required when PUBLIC_URL is set)")
 
 # Prices (promo -> regular)
 PRICES = {
@@ -78,6 +115,16 @@ PLAN_NAMES = {
 SUPPORTED_LANGS = ("ru", "tj")
 DEFAULT_LANG = "ru"
 
+# Broadcast: сколько отправок параллельно
+BROADCAST_CONCURRENCY = 25
+
+# Глобальный лимит исходящих вызовов (Telegram режет на ~30 сообщений/сек) и ретраи на 429
+RATE_LIMIT_PER_SEC = 28
+RATE_LIMIT_RETRIES = 3
+
+# Сколько апдейтов обрабатываются одновременно (остальные ждут своей очереди)
+MAX_CONCURRENT_UPDATES = 256
+
 # =========================
 # LOGGING
 # =========================
@@ -85,61 +132,218 @@ logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
 )
+
+# Сам вывод в stderr делает отдельный поток QueueListener,
+# event loop только кладёт записи в очередь
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+_root_logger = logging.getLogger()
+_log_listener = QueueListener(_log_queue, *_root_logger.handlers, respect_handler_level=True)
+for _h in _root_logger.handlers[:]:
+    _root_logger.removeHandler(_h)
+_root_logger.addHandler(QueueHandler(_log_queue))
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 logger = logging.getLogger("FinanceAcademyTJ_bot")
 
 # =========================
-# STORAGE (safe JSON)
+# STORAGE (SQLite)
 # =========================
-def _safe_read_json(path: str) -> Dict[str, Any]:
+# Одна строка на пользователя: uid -> JSON-документ. Обновление затрагивает
+# только свою строку, журнал (journal_mode=WAL) ведёт сам SQLite.
+_DB: Optional[sqlite3.Connection] = None
+
+# каталог под базу создаём один раз при импорте
+os.makedirs(os.path.dirname(USERS_DB_PATH) or ".", exist_ok=True)
+
+def _db() -> sqlite3.Connection:
+    global _DB
+    if _DB is None:
+        conn = sqlite3.connect(USERS_DB_PATH)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # в WAL-режиме NORMAL не теряет целостность, а fsync только на checkpoint
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS users (uid INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        conn.commit()
+        _DB = conn
+    return _DB
+
+def _close_db() -> None:
+    global _DB
+    if _DB is not None:
+        _DB.close()
+        _DB = None
+
+_UPSERT_SQL = (
+    "INSERT INTO users (uid, data) VALUES (?, ?) "
+    "ON CONFLICT(uid) DO UPDATE SET data = excluded.data"
+)
+
+def _db_save(key: str, data: Dict[str, Any]) -> None:
     try:
-        if not os.path.exists(path):
-            return {}
-        with open(path, "r", encoding="utf-8") as f:
-            raw = f.read().strip()
-            if not raw:
-                return {}
-            data = json.loads(raw)
-            return data if isinstance(data, dict) else {}
+        with _db() as conn:
+            conn.execute(_UPSERT_SQL, (int(key), orjson.dumps(data).decode("utf-8")))
+        _DIRTY_USERS.discard(key)
     except Exception as e:
-        logger.warning("Failed to read JSON %s: %s", path, e)
-        return {}
+        # запись осталась в кэше — пусть _flush_loop попробует ещё раз
+        _DIRTY_USERS.add(key)
+        _DIRTY_EVENT.set()
+        logger.error("Failed to save user %s: %s", key, e)
+
+IMPORT_BATCH_SIZE = 500
+
+def _import_legacy_json() -> None:
+    """
+    Разовый перенос users.json в пустую базу.
+    Файл читаем потоком (ijson) и пишем пачками — целиком в память он не грузится.
+    Сам файл не трогаем — остаётся как резервная копия.
+    """
+    conn = _db()
+    imported = 0
+    rows = []
+
+    def flush() -> None:
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO users (uid, data) VALUES (?, ?)", rows)
+        rows.clear()
 
-def _safe_write_json(path: str, data: Dict[str, Any]) -> None:
-    tmp = path + ".tmp"
     try:
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        os.replace(tmp, path)
+        if os.path.exists(USERS_PATH) and os.path.getsize(USERS_PATH) > 0:
+            with open(USERS_PATH, "rb") as f:
+                for key, data in ijson.kvitems(f, "", use_float=True):
+                    if not isinstance(data, dict):
+                        continue
+                    try:
+                        rows.append((int(key), orjson.dumps(data).decode("utf-8")))
+                    except ValueError:
+                        logger.warning("Skipping non-numeric user id %r from %s", key, USERS_PATH)
+                        continue
+                    imported += 1
+                    if len(rows) >= IMPORT_BATCH_SIZE:
+                        flush()
     except Exception as e:
-        logger.error("Failed to write JSON %s: %s", path, e)
+        logger.warning("Failed to read JSON %s: %s", USERS_PATH, e)
+    if rows:
+        flush()
+
+    if imported:
+        logger.info("Imported %s users from %s into %s", imported, USERS_PATH, USERS_DB_PATH)
+
+def _best_approved_plan(purchases: Any) -> Optional[str]:
+    if not isinstance(purchases, dict):
+        return None
+    for plan in ("VIP", "PRO", "BASIC"):
+        p = purchases.get(plan)
+        if isinstance(p, dict) and p.get("status") == "approved":
+            return plan
+    return None
+
+def _load_users() -> Dict[str, Dict[str, Any]]:
+    conn = _db()
+    if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None:
+        _import_legacy_json()
+    users: Dict[str, Dict[str, Any]] = {}
+    for uid, data in conn.execute("SELECT uid, data FROM users"):
+        try:
+            doc = orjson.loads(data)
+        except orjson.JSONDecodeError as e:
+            logger.warning("Bad user row %s: %s", uid, e)
+            continue
+        if isinstance(doc, dict):
+            # записи до появления approved_plan — досчитываем при загрузке
+            if "approved_plan" not in doc:
+                doc["approved_plan"] = _best_approved_plan(doc.get("purchases"))
+            users[str(uid)] = doc
+    return users
+
+# Все пользователи держим в памяти: читаем базу один раз при старте,
+# дальше все чтения идут из кэша, а изменения сразу пишутся в SQLite.
+USERS_CACHE: Dict[str, Dict[str, Any]] = _load_users()
+
+# Мелкие изменения (last_message и т.п.) копим в памяти и пишем пачкой
+# раз в USERS_FLUSH_INTERVAL секунд — см. touch_user / _flush_loop.
+# Пока изменений нет, цикл спит на _DIRTY_EVENT и не просыпается впустую.
+USERS_FLUSH_INTERVAL = 5
+_DIRTY_USERS: Set[str] = set()
+_DIRTY_EVENT = asyncio.Event()
 
 def get_user(uid: int) -> Dict[str, Any]:
-    users = _safe_read_json(USERS_PATH)
-    u = users.get(str(uid), {})
-    return u if isinstance(u, dict) else {}
+    u = USERS_CACHE.get(str(uid), {})
+    return dict(u) if isinstance(u, dict) else {}
 
-def upsert_user(uid: int, patch: Dict[str, Any]) -> Dict[str, Any]:
-    users = _safe_read_json(USERS_PATH)
-    key = str(uid)
-    cur = users.get(key, {})
+def _user_record(key: str) -> Dict[str, Any]:
+    cur = USERS_CACHE.get(key)
     if not isinstance(cur, dict):
         cur = {}
-    cur.update(patch)
-    users[key] = cur
-    _safe_write_json(USERS_PATH, users)
+        USERS_CACHE[key] = cur
     return cur
 
+def upsert_user(uid: int, patch: Dict[str, Any]) -> Dict[str, Any]:
+    key = str(uid)
+    cur = _user_record(key)
+    cur.update(patch)
+    _db_save(key, cur)
+    return dict(cur)
+
+def touch_user(uid: int, patch: Dict[str, Any]) -> None:
+    """
+    Как upsert_user, но без записи на диск: запись попадёт в базу
+    при следующем flush_dirty_users().
+    """
+    key = str(uid)
+    _user_record(key).update(patch)
+    _DIRTY_USERS.add(key)
+    _DIRTY_EVENT.set()
+
+def mark_blocked(uid: int) -> None:
+    # снимается при следующем сообщении пользователя (см. cmd_start / on_text);
+    # потерять флаг при падении не страшно — следующая рассылка пометит заново
+    touch_user(uid, {"blocked": True, "blocked_ts": int(time.time())})
+
+def flush_dirty_users() -> None:
+    if not _DIRTY_USERS:
+        return
+    keys = list(_DIRTY_USERS)
+    _DIRTY_USERS.clear()
+    rows = [(int(k), orjson.dumps(USERS_CACHE[k]).decode("utf-8")) for k in keys if k in USERS_CACHE]
+    try:
+        with _db() as conn:
+            conn.executemany(_UPSERT_SQL, rows)
+    except Exception as e:
+        _DIRTY_USERS.update(keys)
+        _DIRTY_EVENT.set()
+        logger.error("Failed to flush %s users: %s", len(keys), e)
+
+async def _flush_loop() -> None:
+    while True:
+        await _DIRTY_EVENT.wait()
+        await asyncio.sleep(USERS_FLUSH_INTERVAL)
+        _DIRTY_EVENT.clear()
+        flush_dirty_users()
+
+def _mutate_user(uid: int, fn: Callable[[Dict[str, Any]], None]) -> Dict[str, Any]:
+    """
+    Одно чтение из кэша, fn правит запись на месте, одна запись в базу.
+    """
+    key = str(uid)
+    cur = _user_record(key)
+    fn(cur)
+    _db_save(key, cur)
+    return dict(cur)
+
 def set_purchase_status(uid: int, plan: str, status: str) -> None:
     """
     status: none | requested | approved | denied
     """
-    u = get_user(uid)
-    purchases = u.get("purchases", {})
-    if not isinstance(purchases, dict):
-        purchases = {}
-    purchases[plan] = {"status": status, "ts": int(time.time())}
-    upsert_user(uid, {"purchases": purchases})
+    def apply(cur: Dict[str, Any]) -> None:
+        purchases = cur.get("purchases")
+        if not isinstance(purchases, dict):
+            purchases = cur["purchases"] = {}
+        purchases[plan] = {"status": status, "ts": int(time.time())}
+        # лучший одобренный тариф (VIP > PRO > BASIC) храним отдельным полем
+        cur["approved_plan"] = _best_approved_plan(purchases)
+
+    _mutate_user(uid, apply)
 
 def get_purchase_status(uid: int, plan: str) -> str:
     u = get_user(uid)
@@ -155,26 +359,11 @@ def user_has_access(uid: int) -> bool:
     """
     Доступ считаем открытым, если хотя бы один тариф approved.
     """
-    u = get_user(uid)
-    purchases = u.get("purchases", {})
-    if not isinstance(purchases, dict):
-        return False
-    for plan in ("BASIC", "PRO", "VIP"):
-        p = purchases.get(plan)
-        if isinstance(p, dict) and p.get("status") == "approved":
-            return True
-    return False
+    return get_approved_plan(uid) is not None
 
 def get_approved_plan(uid: int) -> Optional[str]:
-    u = get_user(uid)
-    purchases = u.get("purchases", {})
-    if not isinstance(purchases, dict):
-        return None
-    for plan in ("VIP", "PRO", "BASIC"):
-        p = purchases.get(plan)
-        if isinstance(p, dict) and p.get("status") == "approved":
-            return plan
-    return None
+    u = USERS_CACHE.get(str(uid))
+    return u.get("approved_plan") if isinstance(u, dict) else None
 
 def get_lang(uid: int) -> str:
     u = get_user(uid)
@@ -226,17 +415,22 @@ TEXTS: Dict[str, Dict[str, str]] = {
     },
 }
 
-def t(uid: int, key: str, **fmt: Any) -> str:
-    lang = get_lang(uid)
-    block = TEXTS.get(key, {})
-    txt = block.get(lang) or block.get(DEFAULT_LANG) or ""
+# Плоские таблицы по языкам: fallback на DEFAULT_LANG уже подставлен
+TEXTS_BY_LANG: Dict[str, Dict[str, str]] = {
+    lang: {k: v.get(lang) or v.get(DEFAULT_LANG) or "" for k, v in TEXTS.items()}
+    for lang in SUPPORTED_LANGS
+}
+
+def tl(lang: str, key: str, **fmt: Any) -> str:
+    txt = TEXTS_BY_LANG[lang].get(key, "")
     return txt.format(**fmt) if fmt else txt
 
 # =========================
 # UI
 # =========================
-def main_menu(uid: int) -> ReplyKeyboardMarkup:
-    lang = get_lang(uid)
+_MAIN_MENU_CACHE: Dict[str, ReplyKeyboardMarkup] = {}
+
+def _build_main_menu(lang: str) -> ReplyKeyboardMarkup:
     kb = [
         [KeyboardButton(TEXTS["menu_courses"][lang]), KeyboardButton(TEXTS["menu_buy"][lang])],
         [KeyboardButton(TEXTS["menu_account"][lang]), KeyboardButton(TEXTS["menu_support"][lang])],
@@ -244,24 +438,31 @@ def main_menu(uid: int) -> ReplyKeyboardMarkup:
     ]
     return ReplyKeyboardMarkup(kb, resize_keyboard=True)
 
-def lang_inline() -> InlineKeyboardMarkup:
-    kb = [[
-        InlineKeyboardButton("Русский", callback_data="lang:ru"),
-        InlineKeyboardButton("Тоҷикӣ", callback_data="lang:tj"),
-    ]]
-    return InlineKeyboardMarkup(kb)
-
-def plans_inline(uid: int) -> InlineKeyboardMarkup:
-    kb = [
-        [
-            InlineKeyboardButton("BASIC", callback_data="plan:BASIC"),
-            InlineKeyboardButton("PRO", callback_data="plan:PRO"),
-            InlineKeyboardButton("VIP", callback_data="plan:VIP"),
-        ],
-        [InlineKeyboardButton("🌐 Website", url=SITE_URL)],
-    ]
-    return InlineKeyboardMarkup(kb)
-def payment_inline(plan: str) -> InlineKeyboardMarkup:
+def main_menu(uid: int) -> ReplyKeyboardMarkup:
+    return main_menu_for_lang(get_lang(uid))
+
+def main_menu_for_lang(lang: str) -> ReplyKeyboardMarkup:
+    # языков всего два — клавиатуры строим один раз и переиспользуем
+    menu = _MAIN_MENU_CACHE.get(lang)
+    if menu is None:
+        menu = _MAIN_MENU_CACHE[lang] = _build_main_menu(lang)
+    return menu
+
+LANG_INLINE = InlineKeyboardMarkup([[
+    InlineKeyboardButton("Русский", callback_data="lang:ru"),
+    InlineKeyboardButton("Тоҷикӣ", callback_data="lang:tj"),
+]])
+
+PLANS_INLINE = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("BASIC", callback_data="plan:BASIC"),
+        InlineKeyboardButton("PRO", callback_data="plan:PRO"),
+        InlineKeyboardButton("VIP", callback_data="plan:VIP"),
+    ],
+    [InlineKeyboardButton("🌐 Website", url=SITE_URL)],
+])
+
+def _build_payment_inline(plan: str) -> InlineKeyboardMarkup:
     kb = [
         [
             InlineKeyboardButton("💳 Реквизиты / Реквизитҳо", callback_data=f"pay:details:{plan}"),
@@ -275,9 +476,7 @@ def payment_inline(plan: str) -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(kb)
 
-
-def groups_inline(uid: int, plan: str) -> Optional[InlineKeyboardMarkup]:
-    lang = get_lang(uid)
+def _build_groups_inline(plan: str, lang: str) -> Optional[InlineKeyboardMarkup]:
     buttons = []
     if plan == "BASIC" and GROUP_BASIC_URL:
         buttons.append([InlineKeyboardButton("🔗 " + ("Группа BASIC" if lang == "ru" else "Гурӯҳи BASIC"), url=GROUP_BASIC_URL)])
@@ -287,11 +486,17 @@ def groups_inline(uid: int, plan: str) -> Optional[InlineKeyboardMarkup]:
         buttons.append([InlineKeyboardButton("🔗 " + ("VIP-группа" if lang == "ru" else "Гурӯҳи VIP"), url=GROUP_VIP_URL)])
     return InlineKeyboardMarkup(buttons) if buttons else None
 
+# Инлайн-клавиатуры статичны — собираем один раз при импорте
+_PAYMENT_INLINE: Dict[str, InlineKeyboardMarkup] = {plan: _build_payment_inline(plan) for plan in PRICES}
+_GROUPS_INLINE: Dict[str, Dict[str, Optional[InlineKeyboardMarkup]]] = {
+    plan: {lang: _build_groups_inline(plan, lang) for lang in SUPPORTED_LANGS}
+    for plan in PRICES
+}
+
 # =========================
 # CONTENT
 # =========================
-def courses_text(uid: int) -> str:
-    lang = get_lang(uid)
+def _build_courses_text(lang: str) -> str:
     if lang == "tj":
         return (
             "📚 *Дарсҳои Finance Academy TJ*\n\n"
@@ -324,8 +529,7 @@ def courses_text(uid: int) -> str:
         "Нажми «💳 Купить доступ» и выбери тариф."
     )
 
-def plan_details(uid: int, plan: str) -> str:
-    lang = get_lang(uid)
+def _build_plan_details(plan: str, lang: str) -> str:
     p = PRICES[plan]
     cur = p["currency"]
     promo = p["promo"]
@@ -409,6 +613,13 @@ def plan_details(uid: int, plan: str) -> str:
 
     return "Неизвестный тариф."
 
+# Тексты статичные (SITE_URL и цены известны при старте) — собираем их один раз
+_COURSES_TEXT: Dict[str, str] = {lang: _build_courses_text(lang) for lang in SUPPORTED_LANGS}
+_PLAN_DETAILS: Dict[str, Dict[str, str]] = {
+    plan: {lang: _build_plan_details(plan, lang) for lang in SUPPORTED_LANGS}
+    for plan in PRICES
+}
+
 def account_text(uid: int) -> str:
     lang = get_lang(uid)
     u = get_user(uid)
@@ -455,7 +666,7 @@ def is_admin(uid: int) -> bool:
     # Если ADMIN_ID не задан — считаем админом всех (удобно для теста)
     if not ADMIN_ID:
         return True
-    return str(uid) == str(ADMIN_ID)
+    return uid == ADMIN_CHAT_ID
 
 def fmt_user_brief(update: Update) -> str:
     user = update.effective_user
@@ -464,52 +675,119 @@ def fmt_user_brief(update: Update) -> str:
     name = (user.full_name if user else "—")
     return f"{name} | {username} | ID: {uid}"
 
-async def notify_admin(app: Application, text: str) -> None:
-    if not ADMIN_ID:
+# Уведомления админу копим и отправляем пачкой раз в ADMIN_NOTIFY_INTERVAL секунд
+ADMIN_NOTIFY_INTERVAL = 2
+MAX_MESSAGE_LEN = 4096
+_ADMIN_QUEUE: List[str] = []
+_ADMIN_EVENT = asyncio.Event()
+
+def notify_admin(text: str) -> None:
+    if ADMIN_CHAT_ID is None:
         return
-    try:
-        await app.bot.send_message(chat_id=int(ADMIN_ID), text=text, parse_mode=ParseMode.MARKDOWN)
-    except Exception as e:
-        logger.warning("Failed to notify admin: %s", e)
+    _ADMIN_QUEUE.append(text)
+    _ADMIN_EVENT.set()
+
+async def flush_admin_notifications(app: Application) -> None:
+    if not _ADMIN_QUEUE:
+        return
+    pending = _ADMIN_QUEUE[:]
+    _ADMIN_QUEUE.clear()
+
+    chunks: List[str] = []
+    cur = ""
+    for text in pending:
+        joined = f"{cur}\n\n{text}" if cur else text
+        if cur and len(joined) > MAX_MESSAGE_LEN:
+            chunks.append(cur)
+            cur = text
+        else:
+            cur = joined
+    if cur:
+        chunks.append(cur)
+
+    for i, chunk in enumerate(chunks):
+        try:
+            try:
+                await app.bot.send_message(chat_id=ADMIN_CHAT_ID, text=chunk, parse_mode=ParseMode.MARKDOWN)
+            except BadRequest as e:
+                # одна кривая разметка (например, "_" в username) не должна терять всю пачку
+                logger.warning("Failed to notify admin: %s", e)
+                try:
+                    await app.bot.send_message(chat_id=ADMIN_CHAT_ID, text=chunk)
+                except Exception as e:
+                    logger.warning("Failed to notify admin: %s", e)
+            except Exception as e:
+                # таймаут мог и доставить сообщение, а Forbidden/RetryAfter повтором не лечатся
+                logger.warning("Failed to notify admin: %s", e)
+        except asyncio.CancelledError:
+            # остановка посреди отправки: неотправленное возвращаем в очередь,
+            # его заберёт финальный flush в main_async
+            _ADMIN_QUEUE[:0] = chunks[i:]
+            raise
+
+async def _admin_notify_loop(app: Application) -> None:
+    while True:
+        await _ADMIN_EVENT.wait()
+        await asyncio.sleep(ADMIN_NOTIFY_INTERVAL)
+        _ADMIN_EVENT.clear()
+        await flush_admin_notifications(app)
+
+def save_profile(user: User, activity: Dict[str, Any]) -> None:
+    """
+    Профиль из апдейта + activity. Если имя/username не менялись, на диск
+    сразу не пишем — activity уйдёт в базу с ближайшим flush.
+    """
+    profile = {
+        "first_name": user.first_name,
+        "last_name": user.last_name,
+        "username": user.username,
+        "blocked": False,
+    }
+    cached = USERS_CACHE.get(str(user.id), {})
+    if all(cached.get(k) == v for k, v in profile.items()):
+        touch_user(user.id, activity)
+    else:
+        upsert_user(user.id, {**profile, **activity})
+
+UserHandler = Callable[[Update, ContextTypes.DEFAULT_TYPE, User, int], Awaitable[None]]
+
+def with_user(fn: UserHandler) -> Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]:
+    """
+    Общая обвязка хендлеров сообщений: пропускает апдейты без message/user,
+    передаёт в хендлер user и его id.
+    """
+    @functools.wraps(fn)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        if not update.message or not user:
+            return
+        await fn(update, context, user, user.id)
+    return wrapper
 
 # =========================
 # HANDLERS
 # =========================
-async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = update.effective_user
-    if not update.message or not user:
-        return
-
+@with_user
+async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE, user: User, uid: int) -> None:
     # сохраняем профиль
-    upsert_user(
-        user.id,
-        {
-            "first_name": user.first_name,
-            "last_name": user.last_name,
-            "username": user.username,
-            "started_ts": int(time.time()),
-        },
-    )
+    save_profile(user, {"started_ts": int(time.time())})
 
-    # показываем выбор языка + меню
+    # приветствие сразу с меню + выбор языка
+    lang = get_lang(uid)
     await update.message.reply_text(
-        t(user.id, "welcome"),
+        tl(lang, "welcome"),
         parse_mode=ParseMode.MARKDOWN,
-        reply_markup=lang_inline(),
+        reply_markup=main_menu_for_lang(lang),
     )
     await update.message.reply_text(
-        t(user.id, "choose_lang"),
-        reply_markup=lang_inline(),
+        tl(lang, "choose_lang"),
+        reply_markup=LANG_INLINE,
     )
-    await update.message.reply_text("—", reply_markup=main_menu(user.id))
 
-    await notify_admin(context.application, f"🆕 /start: *{fmt_user_brief(update)}*")
+    notify_admin(f"🆕 /start: *{fmt_user_brief(update)}*")
 
-async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not update.message:
-        return
-    user = update.effective_user
-    uid = user.id if user else 0
+@with_user
+async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE, user: User, uid: int) -> None:
     await update.message.reply_text(
         "Команды:\n"
         "/start — запуск\n"
@@ -517,14 +795,12 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "/approve USER_ID PLAN — подтвердить оплату (admin)\n"
         "/deny USER_ID PLAN — отказать (admin)\n"
         "/broadcast ТЕКСТ — рассылка (admin)\n",
-        reply_markup=main_menu(uid),
+        reply_markup=main_menu_for_lang(get_lang(uid)),
     )
 
-async def cmd_approve(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not update.message:
-        return
-    admin = update.effective_user
-    if not admin or not is_admin(admin.id):
+@with_user
+async def cmd_approve(update: Update, context: ContextTypes.DEFAULT_TYPE, admin: User, admin_id: int) -> None:
+    if not is_admin(admin_id):
         await update.message.reply_text("Нет доступа.")
         return
 
@@ -549,6 +825,7 @@ async def cmd_approve(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     # пользователю — на его языке
     lang = get_lang(uid)
     plan_name = PLAN_NAMES.get(plan, {}).get(lang, plan)
+    bot = context.application.bot
 
     try:
         msg = (
@@ -558,16 +835,16 @@ async def cmd_approve(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                else "Дастрасӣ ба дарсҳо кушода шуд.\n\n«📚 Дарсҳо»-ро пахш кунед ва омӯзишро оғоз намоед.")
         )
 
-        await context.application.bot.send_message(
+        await bot.send_message(
             chat_id=uid,
             text=msg,
             parse_mode=ParseMode.MARKDOWN,
             reply_markup=main_menu(uid),
         )
 
-        gi = groups_inline(uid, plan)
+        gi = _GROUPS_INLINE[plan][lang]
         if gi:
-            await context.application.bot.send_message(
+            await bot.send_message(
                 chat_id=uid,
                 text=("🔗 Ссылка на вашу группу:" if lang == "ru" else "🔗 Истинод ба гурӯҳи шумо:"),
                 reply_markup=gi,
@@ -575,11 +852,9 @@ async def cmd_approve(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     except Exception as e:
         logger.warning("Failed to message user %s: %s", uid, e)
 
-async def cmd_deny(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not update.message:
-        return
-    admin = update.effective_user
-    if not admin or not is_admin(admin.id):
+@with_user
+async def cmd_deny(update: Update, context: ContextTypes.DEFAULT_TYPE, admin: User, admin_id: int) -> None:
+    if not is_admin(admin_id):
         await update.message.reply_text("Нет доступа.")
         return
 
@@ -614,11 +889,9 @@ async def cmd_deny(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     except Exception as e:
         logger.warning("Failed to message user %s: %s", uid, e)
 
-async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not update.message:
-        return
-    admin = update.effective_user
-    if not admin or not is_admin(admin.id):
+@with_user
+async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, admin: User, admin_id: int) -> None:
+    if not is_admin(admin_id):
         await update.message.reply_text("Нет доступа.")
         return
 
@@ -629,93 +902,120 @@ async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
 
     msg = parts[1].strip()
-    users = _safe_read_json(USERS_PATH)
-    sent = 0
-    failed = 0
-
-    for uid_str in users.keys():
+    uids = []
+    bad_ids = 0
+    skipped = 0
+    for uid_str, u in list(USERS_CACHE.items()):
+        # кто заблокировал бота — не тратим на них запросы
+        if isinstance(u, dict) and u.get("blocked"):
+            skipped += 1
+            continue
         try:
-            uid = int(uid_str)
-            await context.application.bot.send_message(chat_id=uid, text=msg, reply_markup=main_menu(uid))
-            sent += 1
-        except Exception:
-            failed += 1
+            uids.append(int(uid_str))
+        except ValueError:
+            bad_ids += 1
+
+    bot = context.bot
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    blocked = 0
+
+    async def send(uid: int) -> None:
+        nonlocal blocked
+        async with sem:
+            try:
+                await bot.send_message(chat_id=uid, text=msg, reply_markup=main_menu(uid))
+            except Forbidden:
+                mark_blocked(uid)
+                blocked += 1
+                raise
+
+    results = await asyncio.gather(*(send(uid) for uid in uids), return_exceptions=True)
+    failed = sum(1 for r in results if isinstance(r, BaseException))
+    sent = len(results) - failed
+    failed += bad_ids
 
-    await update.message.reply_text(f"Рассылка завершена. Отправлено: {sent}, ошибок: {failed}")
+    await update.message.reply_text(
+        f"Рассылка завершена. Отправлено: {sent}, ошибок: {failed} "
+        f"(из них заблокировали бота: {blocked}), пропущено заблокированных: {skipped}"
+    )
 
-async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not update.message:
-        return
-    user = update.effective_user
-    if not user:
-        return
+MenuHandler = Callable[[Update, ContextTypes.DEFAULT_TYPE, int, str], Awaitable[None]]
 
-    uid = user.id
-    text = (update.message.text or "").strip()
+async def _menu_lang(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, lang: str) -> None:
+    await update.message.reply_text(tl(lang, "choose_lang"), reply_markup=LANG_INLINE)
 
-    upsert_user(uid, {
-        "first_name": user.first_name,
-        "last_name": user.last_name,
-        "username": user.username,
-        "last_message": text,
-        "last_message_ts": int(time.time()),
-    })
+async def _menu_courses(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, lang: str) -> None:
+    await update.message.reply_text(
+        _COURSES_TEXT[lang],
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=main_menu_for_lang(lang),
+    )
 
-    # language shortcut button
-    if text in ("🌐 Language / Забон", "🌐 Language", "🌐 Забон", "🌐 Язык"):
-        await update.message.reply_text(t(uid, "choose_lang"), reply_markup=lang_inline())
-        return
+async def _menu_buy(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, lang: str) -> None:
+    await update.message.reply_text(
+        tl(lang, "buy_title"),
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=main_menu_for_lang(lang),
+    )
+    await update.message.reply_text(
+        tl(lang, "choose_plan_below"),
+        reply_markup=PLANS_INLINE,
+    )
+    notify_admin(f"💳 Открыл покупку: *{fmt_user_brief(update)}*")
 
-    lang = get_lang(uid)
+async def _menu_account(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, lang: str) -> None:
+    await update.message.reply_text(
+        account_text(uid),
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=main_menu_for_lang(lang),
+    )
 
-    if text == TEXTS["menu_courses"][lang]:
-        await update.message.reply_text(
-            courses_text(uid),
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=main_menu(uid),
-        )
-        return
+async def _menu_support(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, lang: str) -> None:
+    await update.message.reply_text(
+        tl(lang, "support", tg=SUPPORT_TG, wa=SUPPORT_WA, site=SITE_URL),
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=main_menu_for_lang(lang),
+    )
 
-    if text == TEXTS["menu_buy"][lang]:
-        await update.message.reply_text(
-            t(uid, "buy_title"),
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=main_menu(uid),
-        )
-        await update.message.reply_text(
-            t(uid, "choose_plan_below"),
-            reply_markup=plans_inline(uid),
-        )
-        await notify_admin(context.application, f"💳 Открыл покупку: *{fmt_user_brief(update)}*")
-        return
+# текст кнопки -> обработчик, отдельно для каждого языка
+_LANG_BUTTONS = ("🌐 Language / Забон", "🌐 Language", "🌐 Забон", "🌐 Язык")
+_MENU_DISPATCH: Dict[str, Dict[str, MenuHandler]] = {
+    lang: {
+        **{b: _menu_lang for b in _LANG_BUTTONS},
+        TEXTS["menu_courses"][lang]: _menu_courses,
+        TEXTS["menu_buy"][lang]: _menu_buy,
+        TEXTS["menu_account"][lang]: _menu_account,
+        TEXTS["menu_support"][lang]: _menu_support,
+    }
+    for lang in SUPPORTED_LANGS
+}
 
-    if text == TEXTS["menu_account"][lang]:
-        await update.message.reply_text(
-            account_text(uid),
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=main_menu(uid),
-        )
-        return
+@with_user
+async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE, user: User, uid: int) -> None:
+    text = (update.message.text or "").strip()
 
-    if text == TEXTS["menu_support"][lang]:
-        await update.message.reply_text(
-            t(uid, "support", tg=SUPPORT_TG, wa=SUPPORT_WA, site=SITE_URL),
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=main_menu(uid),
-        )
+    save_profile(user, {"last_message": text, "last_message_ts": int(time.time())})
+
+    lang = get_lang(uid)
+
+    handler = _MENU_DISPATCH[lang].get(text)
+    if handler:
+        await handler(update, context, uid, lang)
         return
 
+    menu = main_menu_for_lang(lang)
+
     # если нет доступа — не даем контент
     if not user_has_access(uid):
         await update.message.reply_text(
-            t(uid, "no_access", site=SITE_URL),
+            tl(lang, "no_access", site=SITE_URL),
             parse_mode=ParseMode.MARKDOWN,
-            reply_markup=main_menu(uid),
+            reply_markup=menu,
         )
         return
 
     # доступ активен
-    await update.message.reply_text(t(uid, "access_active"), reply_markup=main_menu(uid))
+    await update.message.reply_text(tl(lang, "access_active"), reply_markup=menu)
 
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
@@ -733,7 +1033,9 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         lang = data.split(":", 1)[1].strip().lower()
         set_lang(uid, lang)
         await query.edit_message_text(TEXTS["lang_set_tj"]["tj"] if lang == "tj" else TEXTS["lang_set_ru"]["ru"])
-        await context.application.bot.send_message(chat_id=uid, text="—", reply_markup=main_menu(uid))
+        await context.application.bot.send_message(
+            chat_id=uid, text="—", reply_markup=main_menu_for_lang(get_lang(uid))
+        )
         return
 
     if data.startswith("plan:"):
@@ -742,16 +1044,15 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             await query.edit_message_text("Ошибка тарифа.")
             return
 
-        upsert_user(uid, {"last_selected_plan": plan, "last_selected_plan_ts": int(time.time())})
+        touch_user(uid, {"last_selected_plan": plan, "last_selected_plan_ts": int(time.time())})
 
         await query.edit_message_text(
-            plan_details(uid, plan),
+            _PLAN_DETAILS[plan][get_lang(uid)],
             parse_mode=ParseMode.MARKDOWN,
-            reply_markup=payment_inline(plan),
+            reply_markup=_PAYMENT_INLINE[plan],
         )
 
-        await notify_admin(
-            context.application,
+        notify_admin(
             f"📌 Выбрал тариф: *{plan}* | *{fmt_user_brief(update)}*\n"
             f"Цена акция: *{PRICES[plan]['promo']}{PRICES[plan]['currency']}* → обычно *{PRICES[plan]['regular']}{PRICES[plan]['currency']}*",
         )
@@ -777,8 +1078,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
              f"🌐 Тафсилот: {SITE_URL}")
         )
 
-        await notify_admin(
-            context.application,
+        notify_admin(
             "🧾 *Новая заявка на оплату*\n\n"
             f"👤 {fmt_user_brief(update)}\n"
             f"📦 Тариф: *{PLAN_NAMES.get(plan, {}).get('ru', plan)}*\n"
@@ -790,58 +1090,173 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         )
         return
 
+# /команда -> хендлер; один MessageHandler вместо цепочки CommandHandler
+COMMANDS: Dict[str, Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]] = {
+    "start": cmd_start,
+    "help": cmd_help,
+    "approve": cmd_approve,
+    "deny": cmd_deny,
+    "broadcast": cmd_broadcast,
+}
+
+async def on_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    message = update.message
+    if not message or not message.text or not message.entities:
+        return
+    # как в CommandHandler: команда — первый entity, "/cmd@bot" для чужого бота игнорируем
+    command, _, target = message.text[1:message.entities[0].length].partition("@")
+    if target and target.lower() != (context.bot.username or "").lower():
+        return
+    fn = COMMANDS.get(command.lower())
+    if fn is None:
+        return
+    context.args = message.text.split()[1:]
+    await fn(update, context)
+
 async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.exception("Unhandled error: %s", context.error)
 
 # =========================
-# MAIN
+# TELEGRAM HTTP
 # =========================
-def main() -> None:
-    app = Application.builder().token(BOT_TOKEN).build()
-
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("help", cmd_help))
-
-    app.add_handler(CommandHandler("approve", cmd_approve))
-    app.add_handler(CommandHandler("deny", cmd_deny))
-    app.add_handler(CommandHandler("broadcast", cmd_broadcast))
+class OrjsonRequest(HTTPXRequest):
+    """
+    HTTPXRequest, который разбирает ответы Bot API (включая getUpdates) через orjson.
+    """
 
-    app.add_handler(CallbackQueryHandler(on_callback))
-    app.add_handler(MessageHandler(filters.PHOTO, handle_receipt_photo))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> Dict[str, Any]:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # битый UTF-8 и т.п. — отдаём штатному парсеру PTB (decode с errors="replace")
+            return HTTPXRequest.parse_json_payload(payload)
 
-    app.add_error_handler(on_error)
+# =========================
+# MAIN
+# =========================
+def fire(app: Application, coro: Coroutine[Any, Any, Any]) -> "asyncio.Task[Any]":
+    """
+    asyncio.create_task со strong-ссылкой в app.bot_data["_tasks"]:
+    event loop держит задачи только по weakref, и GC может снести их на середине.
+    """
+    tasks = app.bot_data.setdefault("_tasks", set())
+    task = asyncio.create_task(coro)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
 
-    logger.info("Bot started")
-import asyncio
+class _TextNonCommand(filters.MessageFilter):
+    """
+    То же, что filters.TEXT & ~filters.COMMAND, но одной проверкой:
+    есть текст и он не начинается с bot_command.
+    """
 
-async def main_async() -> None:
-    app = Application.builder().token(BOT_TOKEN).build()
+    __slots__ = ()
 
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("help", cmd_help))
+    def filter(self, message: Message) -> bool:
+        if not message.text:
+            return False
+        entities = message.entities
+        if not entities:
+            return True
+        first = entities[0]
+        return not (first.type == MessageEntity.BOT_COMMAND and first.offset == 0)
 
-    app.add_handler(CommandHandler("approve", cmd_approve))
-    app.add_handler(CommandHandler("deny", cmd_deny))
-    app.add_handler(CommandHandler("broadcast", cmd_broadcast))
+TEXT_NONCMD = _TextNonCommand(name="TEXT_NONCMD")
 
+def _register(app: Application) -> None:
+    # без block=False: параллельность даёт concurrent_updates, и лимит MAX_CONCURRENT_UPDATES
+    # действует, только пока хендлер держит слот до конца обработки
+    app.add_handler(MessageHandler(filters.COMMAND, on_command))
     app.add_handler(CallbackQueryHandler(on_callback))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
+    app.add_handler(MessageHandler(TEXT_NONCMD, on_text))
 
     app.add_error_handler(on_error)
 
-    logger.info("Bot started")
+async def main_async() -> None:
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(MAX_CONCURRENT_UPDATES)
+        # темп отправки держит AIORateLimiter, в т.ч. для рассылки
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=RATE_LIMIT_PER_SEC,
+            overall_time_period=1,
+            max_retries=RATE_LIMIT_RETRIES,
+        ))
+        # исходящие вызовы мультиплексируются по HTTP/2 поверх общего пула,
+        # getUpdates держит отдельное соединение под long polling
+        .request(OrjsonRequest(http_version="2", connection_pool_size=256, pool_timeout=5.0, connect_timeout=5.0))
+        .get_updates_request(OrjsonRequest(http_version="2", connection_pool_size=1))
+        .build()
+    )
+
+    _register(app)
 
-    # Полный async запуск (исправление ошибки event loop в Python 3.14)
+    # SIGINT/SIGTERM не убивают процесс, а запускают штатную остановку ниже
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    # Полный async запуск (исправление ошибки event loop в Python 3.14):
+    # run_polling() в PTB 21.6 опирается на asyncio.get_event_loop(), поэтому жизненный цикл ведём сами
+    # initialize() делает getMe через основной клиент: токен проверен, исходящее соединение открыто
+    # (у getUpdates свой пул — его соединение откроет первый long poll)
     await app.initialize()
-    await app.start()
-    await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    logger.info("Logged in as @%s", app.bot.username)
+    try:
+        app.bot_data["_tasks"] = set()
+        await app.start()
+        if PUBLIC_URL:
+            await app.updater.start_webhook(
+                listen="0.0.0.0",
+                port=PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{PUBLIC_URL}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES,
+            )
+        else:
+            await app.updater.start_polling(
+                timeout=POLL_TIMEOUT,
+                poll_interval=0.0,
+                allowed_updates=ALLOWED_UPDATES,
+            )
 
-    # Держим бота запущенным бесконечно
-    await asyncio.Event().wait()
+        fire(app, _flush_loop())
+        fire(app, _admin_notify_loop(app))
+
+        logger.info("Bot started")
+        await stop_event.wait()
+        logger.info("Stopping bot")
+    finally:
+        # порядок как в run_polling: updater -> app (дожидается хендлеров) -> shutdown
+        if app.updater.running:
+            await app.updater.stop()
+        if app.running:
+            await app.stop()
+        tasks = list(app.bot_data.get("_tasks", ()))
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await flush_admin_notifications(app)
+        flush_dirty_users()
+        await app.shutdown()
 
 
 if __name__ == "__main__":
-    asyncio.run(main_async())
+    try:
+        if uvloop is not None:
+            uvloop.run(main_async())
+        else:
+            asyncio.run(main_async())
+    finally:
+        flush_dirty_users()
+        _close_db()
 
  